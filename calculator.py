@@ -5,6 +5,8 @@
    factor is halved.
 """
 from __future__ import division
+import math
+import numpy
 import random
 from cctbx import xray
 from libtbx import adopt_init_args
@@ -12,13 +14,114 @@ from scitbx.array_family import flex
 import cctbx.maptbx.real_space_refinement_simple
 import scitbx.lbfgs
 
+def _filtered_norm(g):
+  """
+  Norm of gradients g (flex.vec3_double) ignoring per-atom contributions
+  whose squared length exceeds 36 times the mean squared length.
+  """
+  a = g.as_double().as_numpy_array().reshape(-1, 3)
+  ns = numpy.einsum('ij,ij->i', a, a)
+  cutoff = ns.sum()/max(ns.size, 1)*36
+  # sum the kept entries: subtracting outliers from the total loses all
+  # precision exactly when the outliers dominate
+  return math.sqrt(ns[ns <= cutoff].sum())
+
+def get_hd_selections(xrs):
+  """
+  Return (hd_selection, not_hd_selection, not_hd_iselection) for xrs. All
+  depend only on the scattering types, so they are computed once and kept on
+  the structure. The iselection is for gathering sites; the restraints
+  manager's select() needs the boolean form.
+  """
+  result = getattr(xrs, "_qrefine_hd_selections", None)
+  if(result is None or result[0].size() != xrs.scatterers().size()):
+    hd_sel = xrs.hd_selection()
+    not_hd_sel = ~hd_sel
+    result = (hd_sel, not_hd_sel, not_hd_sel.iselection())
+    xrs._qrefine_hd_selections = result
+  return result
+
+class restraints_selection_memo(object):
+  """
+  Single-entry memo for restraints_manager.select(selection). Rebuilding the
+  selected proxy arrays costs about as much as the energy evaluation itself,
+  and the same (restraints manager, not-H selection) pair is used throughout.
+  """
+  def __init__(self):
+    self.restraints_manager = None
+    self.selection = None
+    self.result = None
+
+  def select(self, restraints_manager, selection):
+    if(self.restraints_manager is not restraints_manager or
+       self.selection.size() != selection.size() or
+       not self.selection.all_eq(selection)):
+      self.result = restraints_manager.select(selection)
+      self.restraints_manager = restraints_manager
+      self.selection = selection.deep_copy()
+    return self.result
+
+_restraints_selection_memo = restraints_selection_memo()
+
+def select_restraints(restraints_manager, selection):
+  return _restraints_selection_memo.select(restraints_manager, selection)
+
+class bonds_rmsd_memo(object):
+  """
+  Single-entry memo for get_bonds_rmsd(): the bonded-energy pass is skipped if
+  called again with the same restraints manager and unchanged coordinates
+  (e.g. run_collect() followed by adjust_restraints_weight_scale()).
+  """
+  def __init__(self):
+    self.restraints_manager = None
+    self.sites_cart = None
+    self.bonds_rmsd = None
+
+  def get(self, restraints_manager, sites_cart):
+    if(self.restraints_manager is not restraints_manager): return None
+    x = sites_cart.as_double()
+    if(self.sites_cart.size() != x.size()): return None
+    if(not self.sites_cart.all_eq(x)): return None
+    return self.bonds_rmsd
+
+  def set(self, restraints_manager, sites_cart, bonds_rmsd):
+    self.restraints_manager = restraints_manager
+    self.sites_cart = sites_cart.as_double()
+    self.bonds_rmsd = bonds_rmsd
+
+_bonds_rmsd_memo = bonds_rmsd_memo()
+
 def get_bonds_rmsd(restraints_manager, xrs):
-  hd_sel = xrs.hd_selection()
+  sites_cart = xrs.sites_cart()
+  result = _bonds_rmsd_memo.get(restraints_manager, sites_cart)
+  if(result is not None): return result
+  hd_selections = get_hd_selections(xrs)
   energies_sites = \
-    restraints_manager.select(~hd_sel).energies_sites(
-      sites_cart        = xrs.sites_cart().select(~hd_sel),
+    select_restraints(restraints_manager, hd_selections[1]).energies_sites(
+      sites_cart        = sites_cart.select(hd_selections[2]),
       compute_gradients = False)
-  return energies_sites.bond_deviations()[2]
+  result = energies_sites.bond_deviations()[2]
+  _bonds_rmsd_memo.set(restraints_manager, sites_cart, result)
+  return result
+
+# r_free-r_work gap (in percent) below which the weight is relaxed rather
+# than tightened
+_R_GAP_THR = 5.
+
+def weight_scale_action(bonds_rmsd, max_bond_rmsd, rf, rw):
+  """
+  How adjust_restraints_weight_scale changes the restraints weight scale:
+  1 multiplies it by the scale, -1 divides it, 0 leaves it alone (bond rmsd
+  exactly at max with r_free >= r_work, r_free == r_work, or a gap of
+  exactly _R_GAP_THR).
+  """
+  if(bonds_rmsd>max_bond_rmsd): return 1
+  if(rf<rw): return -1
+  if(bonds_rmsd<max_bond_rmsd and rf>rw):
+    gap = abs(rf-rw)*100.
+    if(gap<_R_GAP_THR): return -1
+    if(gap>_R_GAP_THR): return 1
+  return 0
 
 class weights(object):
   def __init__(self,
@@ -32,8 +135,8 @@ class weights(object):
     else:
       self.weight_was_provided = False
     self.restraints_weight_scales = flex.double([self.restraints_weight_scale])
-    self.r_frees = []
-    self.r_works = []
+    self.r_frees = flex.double()
+    self.r_works = flex.double()
 
   def scale_restraints_weight(self):
     if(self.weight_was_provided): return
@@ -53,55 +156,55 @@ class weights(object):
       restraints_manager = geometry_rmsd_manager.geometry,
       xrs                = fmodel.xray_structure)
     ####
-    adjusted = False
-    if(cctbx_rm_bonds_rmsd>max_bond_rmsd):
+    action = weight_scale_action(
+      bonds_rmsd    = cctbx_rm_bonds_rmsd,
+      max_bond_rmsd = max_bond_rmsd,
+      rf            = rf,
+      rw            = rw)
+    if(action>0):
       self.restraints_weight_scale *= scale
-      adjusted = True
-    if(not adjusted and rf<rw):
-      self.restraints_weight_scale /= scale
-      adjusted = True
-    if(not adjusted and cctbx_rm_bonds_rmsd<max_bond_rmsd and rf>rw and
-       abs(rf-rw)*100.<5.):
+    elif(action<0):
       self.restraints_weight_scale /= scale
-      adjusted = True
-    if(not adjusted and cctbx_rm_bonds_rmsd<max_bond_rmsd and rf>rw and
-       abs(rf-rw)*100.>5.):
-      self.restraints_weight_scale *= scale
-      adjusted = True
+    adjusted = action != 0
     ####
-    self.r_frees.append(round(rf,4))
-    self.r_works.append(round(rw,4))
+    self.r_frees.append(rf)
+    self.r_works.append(rw)
     return adjusted
 
   def add_restraints_weight_scale_to_restraints_weight_scales(self):
     if(self.weight_was_provided): return
     self.restraints_weight_scales.append(self.restraints_weight_scale)
 
-  def compute_weight(self, fmodel, rm):
+  def compute_weight(self, fmodel, rm, x_target_functor=None):
     if(self.weight_was_provided): return
     random.seed(1)
     flex.set_random_seed(1)
-    #
-    fmodel_dc = fmodel.deep_copy()
-    xrs = fmodel_dc.xray_structure.deep_copy_scatterers()
+    # Shake in place and restore afterwards instead of copying the whole fmodel
+    xrs = fmodel.xray_structure
+    sites_frac_start = None
     if(self.shake_sites):
-      xrs.shake_sites_in_place(mean_distance=0.2)
-    fmodel_dc.update_xray_structure(xray_structure=xrs, update_f_calc=True)
-    x_target_functor = fmodel_dc.target_functor()
-    tgx = x_target_functor(compute_gradients=True)
-    gx = flex.vec3_double(tgx.\
-            gradients_wrt_atomic_parameters(site=True).packed())
-    tc, gc = rm.target_and_gradients(sites_cart=xrs.sites_cart())
-    x = gc.norm()
-    y = gx.norm()
+      sites_frac_start = xrs.sites_frac()
+    try:
+      if(self.shake_sites):
+        # isotropic Gaussian shifts with an rms displacement of 0.2 A
+        sites = xrs.sites_cart().as_double().as_numpy_array()
+        sites += numpy.random.RandomState(1).normal(
+          0.0, 0.2/math.sqrt(3.0), sites.size)
+        xrs.set_sites_cart(flex.vec3_double(flex.double(sites)))
+        fmodel.update_xray_structure(xray_structure=xrs, update_f_calc=True)
+      if(x_target_functor is None):
+        x_target_functor = fmodel.target_functor()
+      tgx = x_target_functor(compute_gradients=True)
+      gx = flex.vec3_double(tgx.\
+              gradients_wrt_atomic_parameters(site=True).packed())
+      tc, gc = rm.target_and_gradients(sites_cart=xrs.sites_cart())
+    finally:
+      if(sites_frac_start is not None):
+        xrs.set_sites_frac(sites_frac_start)
+        fmodel.update_xray_structure(xray_structure=xrs, update_f_calc=True)
     # filter out large contributions
-    gx_d = flex.sqrt(gx.dot())
-    sel = gx_d>flex.mean(gx_d)*6
-    y = gx.select(~sel).norm()
-    #
-    gc_d = flex.sqrt(gc.dot())
-    sel = gc_d>flex.mean(gc_d)*6
-    x = gc.select(~sel).norm()
+    y = _filtered_norm(gx)
+    x = _filtered_norm(gc)
     ################
     if(y != 0.0): self.data_weight = x/y
     else:         self.data_weight = 1.0 # ad hoc default fallback
@@ -138,21 +241,40 @@ class sites_opt(calculator):
     self.dump_gradients = dump_gradients
     self.restraints_manager = restraints_manager
     self.x = None
+    self.sites_cart = None
     self.xray_structure = xray_structure
     self.not_hd_selection = None # XXX UGLY
+    self.not_hd_iselection = None
+    self._cached_x = None
+    self._cached_target_and_gradients = None
     self.initialize(xray_structure = self.xray_structure)
 
   def initialize(self, xray_structure=None):
-    self.not_hd_selection = ~self.xray_structure.hd_selection() # XXX UGLY
-    self.x = self.xray_structure.sites_cart().as_double()
+    self.reset_cache()
+    hd_selections = get_hd_selections(self.xray_structure)
+    self.not_hd_selection = hd_selections[1] # XXX UGLY
+    self.not_hd_iselection = hd_selections[2]
+    self.sites_cart = self.xray_structure.sites_cart()
+    self.x = self.sites_cart.as_double()
 
   def update(self, x):
+    # x is the flat array owned by L-BFGS; build the vec3 view only once
     self.x = x
+    self.sites_cart = flex.vec3_double(x)
+
+  def reset_cache(self):
+    self._cached_x = None
+    self._cached_target_and_gradients = None
 
   def target_and_gradients(self, x):
-    self.update(x = x)
-    f, g = self.restraints_manager.target_and_gradients(
-      sites_cart = flex.vec3_double(self.x))
+    # same-point re-evaluations by L-BFGS reuse the last restraints result
+    if(self._cached_x is None or not self._cached_x.all_eq(x)):
+      self.update(x = x)
+      self._cached_target_and_gradients = \
+        self.restraints_manager.target_and_gradients(
+          sites_cart = self.sites_cart)
+      self._cached_x = x.deep_copy()
+    f, g = self._cached_target_and_gradients
     if(self.dump_gradients is not None):
       from libtbx import easy_pickle
       easy_pickle.dump(self.dump_gradients, g)
@@ -160,6 +282,8 @@ class sites_opt(calculator):
     return f, g.as_double()
 
   def update_xray_structure(self):
+    # not self.sites_cart: after a failed line search L-BFGS restores x to
+    # the best point, and sites_cart still holds the rejected trial step
     self.xray_structure.set_sites_cart(
       sites_cart = flex.vec3_double(self.x))
 
@@ -171,25 +295,54 @@ class sites(calculator):
                dump_gradients=None):
     adopt_init_args(self, locals())
     self.x = None
+    self.sites_cart = None
     self.x_target_functor = None
+    self._target_functor_fmodel = None
     self.not_hd_selection = None # XXX UGLY
+    self.not_hd_iselection = None
+    self._cached_x = None
+    self._cached_target_and_gradients = None
     self.initialize(fmodel = self.fmodel)
 
   def initialize(self, fmodel=None):
-    self.not_hd_selection = ~self.fmodel.xray_structure.hd_selection() # XXX UGLY
     assert fmodel is not None
     self.fmodel = fmodel
+    self.reset_cache()
+    hd_selections = get_hd_selections(self.fmodel.xray_structure)
+    self.not_hd_selection = hd_selections[1] # XXX UGLY
+    self.not_hd_iselection = hd_selections[2]
     self.fmodel.xray_structure.scatterers().flags_set_grads(state=False)
     xray.set_scatterer_grad_flags(
       scatterers = self.fmodel.xray_structure.scatterers(),
       site       = True)
-    self.x = self.fmodel.xray_structure.sites_cart().as_double()
-    self.x_target_functor = self.fmodel.target_functor()
+    self.sites_cart = self.fmodel.xray_structure.sites_cart()
+    self.x = self.sites_cart.as_double()
+    # reset_fmodel() is mostly called with the fmodel we already have; the
+    # functor only refers to fmodel, so keep it unless the object changes
+    if(self.x_target_functor is None or
+       self._target_functor_fmodel is not self.fmodel):
+      self.x_target_functor = self.fmodel.target_functor()
+      self._target_functor_fmodel = self.fmodel
+
+  def reset_cache(self):
+    """
+    Forget the cached targets and gradients. Must be called whenever fmodel
+    or the restraints change other than through update() (scales, mask, new
+    fmodel, re-clustering).
+    """
+    self._cached_x = None
+    self._cached_target_and_gradients = None
+
+  def update_fmodel(self):
+    self.reset_cache()
+    super(sites, self).update_fmodel()
 
   def calculate_weight(self):
+    self.reset_cache()
     self.weights.compute_weight(
-      fmodel = self.fmodel,
-      rm     = self.restraints_manager)
+      fmodel           = self.fmodel,
+      rm               = self.restraints_manager,
+      x_target_functor = self.x_target_functor)
 
   def reset_fmodel(self, fmodel=None):
     if(fmodel is not None):
@@ -201,30 +354,41 @@ class sites(calculator):
     self.weights.restraints_weight_scale = restraints_weight_scale
 
   def update(self, x):
-    self.x = flex.vec3_double(x)
-    self.fmodel.xray_structure.set_sites_cart(sites_cart = self.x)
+    # x stays the flat array owned by L-BFGS; build the vec3 view only once
+    self.x = x
+    self.sites_cart = flex.vec3_double(x)
+    self.fmodel.xray_structure.set_sites_cart(sites_cart = self.sites_cart)
     self.fmodel.update_xray_structure(
       xray_structure = self.fmodel.xray_structure,
       update_f_calc  = True)
 
   def target_and_gradients(self, x):
-    self.update(x = x)
-    rt, rg = self.restraints_manager.target_and_gradients(sites_cart = self.x)
-    tgx = self.x_target_functor(compute_gradients=True)
-    dt = tgx.target_work()
-    dg = flex.vec3_double(tgx.\
-      gradients_wrt_atomic_parameters(site=True).packed())
+    # L-BFGS may evaluate the same point twice (e.g. after a line search
+    # restart); skip the f_calc update and both targets in that case.
+    # x is modified in place by L-BFGS, so compare against a copy.
+    if(self._cached_x is None or not self._cached_x.all_eq(x)):
+      self.update(x = x)
+      rt, rg = self.restraints_manager.target_and_gradients(
+        sites_cart = self.sites_cart)
+      tgx = self.x_target_functor(compute_gradients=True)
+      self._cached_target_and_gradients = (tgx.target_work(),
+        tgx.gradients_wrt_atomic_parameters(site=True).packed(), rt, rg)
+      self._cached_x = x.deep_copy()
+    dt, dg, rt, rg = self._cached_target_and_gradients
     t = dt*self.weights.data_weight + \
       self.weights.restraints_weight*rt*self.weights.restraints_weight_scale
-    g = dg*self.weights.data_weight + \
-      self.weights.restraints_weight*rg*self.weights.restraints_weight_scale
+    # combine in the flat layout L-BFGS wants: one scaled copy of rg, one
+    # scaled temporary of dg added in place
+    g = rg.as_double()
+    g *= self.weights.restraints_weight*self.weights.restraints_weight_scale
+    g += dg*self.weights.data_weight
     if(self.dump_gradients is not None):
       from libtbx import easy_pickle
-      easy_pickle.dump(self.dump_gradients+"_dg", dg.as_double())
+      easy_pickle.dump(self.dump_gradients+"_dg", dg)
       easy_pickle.dump(self.dump_gradients+"_rg", rg.as_double())
-      easy_pickle.dump(self.dump_gradients+"_g", g.as_double())
+      easy_pickle.dump(self.dump_gradients+"_g", g)
       STOP()
-    return t, g.as_double()
+    return t, g
 
 class adp(calculator):
   def __init__(self,
@@ -304,3 +468,4 @@ class sites_real_space(object):
       real_space_gradients_delta      = 0.25,
       lbfgs_termination_params        = self.lbfgs_termination_params,
       lbfgs_exception_handling_params = self.lbfgs_exception_handling_params)
+    return refined
@@ -4,10 +4,11 @@ import os
 from libtbx import Auto
 from libtbx.utils import Sorry
 from libtbx import adopt_init_args
+from libtbx import easy_mp
 from libtbx.easy_mp import parallel_map
 from scitbx.array_family import flex
 from fragment import fragment_extracts
-from restraints import from_qm
+from restraints import from_qm, from_cctbx
 
 class from_cluster(object):
   def __init__(self, restraints_manager, fragment_manager, parallel_params):
@@ -28,20 +29,41 @@ class from_cluster(object):
       file_name=self.restraints_manager.file_name,
       crystal_symmetry=self.fragment_manager.expansion.cs_box)
     fragment_extracts_obj = fragment_extracts(self.fragment_manager)
+    qm = isinstance(self.restraints_manager, from_qm)
     # super_sphere_geometry_restraints_manager will cause qusb submits
     # a single job instead of batch jobs
-    if(isinstance(self.restraints_manager, from_qm)):
+    if(qm):
       fragment_extracts_obj.super_sphere_geometry_restraints_manager=None
     self.restraints_manager.fragment_extracts = fragment_extracts_obj
+    if(isinstance(self.restraints_manager, from_cctbx)):
+      # fill the per-fragment restraints cache here so that forked workers
+      # inherit it instead of each rebuilding (and dropping) its own copy
+      for index in range(len(self.fragment_manager.fragment_selections)):
+        self.restraints_manager.get_fragment_restraints(index)
+    # each job gets only the coordinates it reads: from_qm builds the
+    # fragments from fragment_extracts, from_cctbx needs the fragment's sites
     selection_and_sites_cart=[]
     for index, selection_fragment in enumerate(
                        self.fragment_manager.fragment_selections):
-       selection_and_sites_cart.append([selection_fragment, sites_cart,index])
+       if(qm): fragment_sites_cart = None
+       else:
+         fragment_sites_cart = sites_cart.select(
+           self.fragment_manager.fragment_super_selections[index])
+       selection_and_sites_cart.append(
+         [selection_fragment, fragment_sites_cart, index])
        if(0):##for debugging parallel_map
-         self.restraints_manager.target_and_gradients(sites_cart=sites_cart,
+         self.restraints_manager.target_and_gradients(
+                          sites_cart=fragment_sites_cart,
                           selection=selection_fragment, index=index)
     if(self.parallel_params.nproc is None):
       self.parallel_params.nproc = Auto
+    # fragments on one node share its cores: divide the QM threads between
+    # the jobs that run concurrently
+    if(isinstance(self.restraints_manager, from_qm) and
+       self.parallel_params.method in ["multiprocessing", "threading"]):
+      n_jobs = min(easy_mp.get_processes(self.parallel_params.nproc),
+                   len(selection_and_sites_cart))
+      self.restraints_manager.share_nproc(n_jobs=n_jobs)
     ncount=0
     energy_gradients=None
     while(ncount<5 and energy_gradients is None):
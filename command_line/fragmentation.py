@@ -5,6 +5,8 @@ import time
 import os.path
 import libtbx
 import iotbx.pdb
+from libtbx import Auto
+from libtbx import easy_mp
 from qrefine.fragment import fragments
 from qrefine.fragment import fragment_extracts
 from qrefine.fragment import get_qm_file_name_and_pdb_hierarchy
@@ -20,7 +22,7 @@ legend = """\
 Cluster a system into many small pieces
 """
 
-def run(pdb_file, log):
+def run(pdb_file, log, nproc=Auto):
   pdb_inp = iotbx.pdb.input(pdb_file)
   ph = pdb_inp.construct_hierarchy()
   cs = pdb_inp.crystal_symmetry()
@@ -32,16 +34,22 @@ def run(pdb_file, log):
     qm_engine_name="terachem")
   print >> log, "Residue indices for each cluster:\n", fq.clusters
   fq_ext = fragment_extracts(fq)
-  for i in xrange(len(fq.clusters)):
-      # add capping for the cluster and buffer
-      print >> log, "capping frag:", i
-      get_qm_file_name_and_pdb_hierarchy(
-                          fragment_extracts=fq_ext,
-                          index=i)
-      print >>log, "point charge file:", i
-      #write mm point charge file
-      write_mm_charge_file(fragment_extracts=fq_ext,
-                                      index=i)
+  def process_cluster(i):
+    # add capping for the cluster and buffer
+    print >> log, "capping frag:", i
+    get_qm_file_name_and_pdb_hierarchy(
+                        fragment_extracts=fq_ext,
+                        index=i)
+    print >>log, "point charge file:", i
+    #write mm point charge file
+    write_mm_charge_file(fragment_extracts=fq_ext,
+                                    index=i)
+  # clusters are independent; fixed_func is inherited by the forked workers,
+  # so neither it nor fq_ext has to be pickled
+  easy_mp.pool_map(
+    fixed_func = process_cluster,
+    args       = range(len(fq.clusters)),
+    processes  = nproc)
 
 
 
@@ -55,7 +55,9 @@ def run(args, log):
   model = qr.process_model_file(
     pdb_file_name    = cmdline.pdb_file_names[0],
     cif_objects      = cmdline.cif_objects,
-    crystal_symmetry = cmdline.crystal_symmetry)
+    crystal_symmetry = cmdline.crystal_symmetry,
+    cache_folder     = params.model_cache_folder,
+    log              = log)
   # Read reflection data
   fmodel = None
   if(len(cmdline.reflection_files)>0):
@@ -76,7 +78,9 @@ def run(args, log):
       f_obs          = f_obs,
       r_free_flags   = r_free_flags,
       xray_structure = model.xray_structure,
-      target_name    = params.refine.refinement_target_name)
+      target_name    = params.refine.refinement_target_name,
+      sf_and_grads_accuracy_params = qr.get_sf_and_grads_accuracy_params(
+        params = params))
     if(params.refine.update_all_scales):
       fmodel.update_all_scales(remove_outliers=False)
       fmodel.show(show_header=False, show_approx=False)
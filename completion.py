@@ -1,36 +1,69 @@
+from __future__ import print_function
 import math
 import sys
-from string import letters
+from string import ascii_letters as letters
 
 import iotbx
+import iotbx.pdb.hierarchy
+from libtbx.utils import Sorry
 from mmtbx.monomer_library import server
-from scitbx import matrix
 from scitbx.math import dihedral_angle
 
 from iotbx.pdb import amino_acid_codes as aac
 
 mon_lib_server = server.server()
-get_class = iotbx.pdb.common_residue_names_get_class
+# constructors used once per added atom
+_hierarchy_atom = iotbx.pdb.hierarchy.atom
+_hierarchy_atom_group = iotbx.pdb.hierarchy.atom_group
+_hierarchy_residue_group = iotbx.pdb.hierarchy.residue_group
+_hierarchy_chain = iotbx.pdb.hierarchy.chain
+
+_residue_class_cache = {}
+
+def get_class(resname):
+  # a model has a handful of distinct residue names but every loop below
+  # classifies each atom group again
+  rc = _residue_class_cache.get(resname, None)
+  if rc is None:
+    rc = iotbx.pdb.common_residue_names_get_class(resname)
+    _residue_class_cache[resname] = rc
+  return rc
+
+_CHAIN_ID_TO_INDEX = dict((c, i) for i, c in enumerate(letters))
+# names of hydrogens already counted on a terminal N
+_NTERM_H_NAMES = frozenset(['H', 'H1', 'H2', 'H3', 'HT1', 'HT2'])
 
 from utils import hierarchy_utils
 
 def d_squared(xyz1, xyz2):
-  d2 = 0
-  for i in range(3):
-    d2 += (xyz2[i]-xyz1[i])**2
-  return d2
+  dx = xyz2[0]-xyz1[0]
+  dy = xyz2[1]-xyz1[1]
+  dz = xyz2[2]-xyz1[2]
+  return dx*dx+dy*dy+dz*dz
 
 def get_bond_vector(a1,a2,unit=False):
-  vector = []
-  l = 0
-  for i in range(3):
-    vector.append(a1.xyz[i]-a2.xyz[i])
-    l+=vector[i]**2
+  x1, y1, z1 = a1.xyz
+  x2, y2, z2 = a2.xyz
+  vector = (x1-x2, y1-y2, z1-z2)
   if unit:
-    l=math.sqrt(l)
-    for i in range(3):
-      vector[i] /= l
-  return tuple(vector)
+    l = math.sqrt(vector[0]*vector[0]+vector[1]*vector[1]+vector[2]*vector[2])
+    vector = (vector[0]/l, vector[1]/l, vector[2]/l)
+  return vector
+
+_period_offsets = {}
+
+def _get_period_offsets(period):
+  """
+  (cos, sin) of the dihedral offsets n*2*pi/period of the atoms placed by
+  construct_xyz. Only periods 1-3 occur, so they are computed once and
+  shared by all residues.
+  """
+  rc = _period_offsets.get(period, None)
+  if rc is None:
+    rc = tuple([(math.cos(n*2*math.pi/period), math.sin(n*2*math.pi/period))
+                for n in range(0, period)])
+    _period_offsets[period] = rc
+  return rc
 
 def construct_xyz(ba, bv,
                   aa, av,
@@ -40,46 +73,61 @@ def construct_xyz(ba, bv,
   assert ba is not None
   assert aa is not None
   assert da is not None
-  rn = matrix.col(ba.xyz)
-  rca = matrix.col(aa.xyz)
-  rc = matrix.col(da.xyz)
-  rcca = rc -rca
+  # plain float arithmetic: this runs for every added terminal atom and
+  # matrix.col allocates a wrapper object per vector operation
+  nx, ny, nz = ba.xyz
+  cax, cay, caz = aa.xyz
+  cx, cy, cz = da.xyz
+  # e0 = unit(rn - rca)
+  e0x, e0y, e0z = nx-cax, ny-cay, nz-caz
+  l = math.sqrt(e0x*e0x+e0y*e0y+e0z*e0z)
+  e0x, e0y, e0z = e0x/l, e0y/l, e0z/l
+  # e1 = unit(rcca - (rcca.e0)*e0)
+  rx, ry, rz = cx-cax, cy-cay, cz-caz
+  t = rx*e0x+ry*e0y+rz*e0z
+  e1x, e1y, e1z = rx-t*e0x, ry-t*e0y, rz-t*e0z
+  l = math.sqrt(e1x*e1x+e1y*e1y+e1z*e1z)
+  e1x, e1y, e1z = e1x/l, e1y/l, e1z/l
+  # e2 = e0 x e1
+  e2x = e0y*e1z-e0z*e1y
+  e2y = e0z*e1x-e0x*e1z
+  e2z = e0x*e1y-e0y*e1x
 
-  e0 = (rn - rca).normalize()
-  e1 = (rcca - (rcca.dot(e0))*e0).normalize()
-  e2 = e0.cross(e1)
-
-  pi = math.pi
   alpha = math.radians(av)
   phi = math.radians(dv)
+  bs = bv*math.sin(alpha)
+  bc = bv*math.cos(alpha)
+
+  # cos/sin(phi + offset) by angle addition: no trig inside the loop
+  bs_cos_phi = bs*math.cos(phi)
+  bs_sin_phi = bs*math.sin(phi)
 
   rh_list = []
-  for n in range(0, period):
-    rh = rn + bv * (math.sin(alpha)*(math.cos(phi + n*2*pi/period)*e1 +
-                                     math.sin(phi + n*2*pi/period)*e2) -
-                    math.cos(alpha)*e0)
-    rh_list.append(rh)
+  for cos_offset, sin_offset in _get_period_offsets(period):
+    cp = bs_cos_phi*cos_offset - bs_sin_phi*sin_offset
+    sp = bs_sin_phi*cos_offset + bs_cos_phi*sin_offset
+    rh_list.append((nx + cp*e1x + sp*e2x - bc*e0x,
+                    ny + cp*e1y + sp*e2y - bc*e0y,
+                    nz + cp*e1z + sp*e2z - bc*e0z))
   return rh_list
 
 def _add_atom_to_chain(atom, ag):
   rg = _add_atom_to_residue_group(atom, ag)
   chain = ag.parent().parent()
-  tc = iotbx.pdb.hierarchy.chain()
+  tc = _hierarchy_chain()
   tc.id = chain.id
   tc.append_residue_group(rg)
   return tc
 
 def _add_atom_to_residue_group(atom, ag):
-  tag = iotbx.pdb.hierarchy.atom_group()
+  tag = _hierarchy_atom_group()
   tag.resname = ag.resname
   tag.append_atom(atom)
-  rg = iotbx.pdb.hierarchy.residue_group()
+  rg = _hierarchy_residue_group()
   rg.resseq = ag.parent().resseq
   rg.append_atom_group(tag)
-  for i, c in enumerate(letters):
-    if c==ag.parent().parent().id:
-      break
-  atom.tmp = i
+  # unknown chain ids map to the last letter, as the old linear scan did
+  atom.tmp = _CHAIN_ID_TO_INDEX.get(ag.parent().parent().id, len(letters)-1)
   return rg
 
 def get_atoms_by_names(ag, l=None, all_or_nothing=True):
@@ -88,7 +136,7 @@ def get_atoms_by_names(ag, l=None, all_or_nothing=True):
   for name in l:
     atom = ag.get_atom(name)
     rc.append(atom)
-  if len(l)!=len(filter(None, rc)): return None
+  if len(l)!=len([atom for atom in rc if atom]): return None
   return rc
 
 def add_n_terminal_hydrogens_to_atom_group(ag,
@@ -107,7 +155,10 @@ def add_n_terminal_hydrogens_to_atom_group(ag,
     if ca is None: return 'no CA'
     c = ag.get_atom("C")
     if c is None: return 'no C'
-  atom = ag.get_atom('H')
+  # one pass over the atoms; membership tests below use the name set
+  names = set([a.name.strip() for a in ag.atoms()])
+  atom = None
+  if 'H' in names: atom = ag.get_atom('H')
   dihedral=120.
   if atom:
     dihedral = dihedral_angle(sites=[atom.xyz,
@@ -118,8 +169,9 @@ def add_n_terminal_hydrogens_to_atom_group(ag,
                               deg=True)
   if retain_original_hydrogens: pass
   else:
-    if ag.get_atom("H"): # maybe needs to be smarter or actually work
-      ag.remove_atom(ag.get_atom('H'))
+    if atom: # maybe needs to be smarter or actually work
+      ag.remove_atom(atom)
+      names.discard('H')
   #if use_capping_hydrogens and 0:
   #  for i, atom in enumerate(ag.atoms()):
   #    if atom.name == ' H3 ':
@@ -131,10 +183,7 @@ def add_n_terminal_hydrogens_to_atom_group(ag,
                       c, dihedral,
                      )
   # this could be smarter
-  possible = ['H', 'H1', 'H2', 'H3', 'HT1', 'HT2']
-  h_count = 0
-  for h in possible:
-    if ag.get_atom(h): h_count+=1
+  h_count = len(names & _NTERM_H_NAMES)
   number_of_hydrogens=3
   if use_capping_hydrogens:
     number_of_hydrogens-=1
@@ -142,20 +191,21 @@ def add_n_terminal_hydrogens_to_atom_group(ag,
     #  number_of_hydrogens=-1
     #  # should name the hydrogens correctly
   if h_count>=number_of_hydrogens: return []
+  n_occ, n_b = n.occ, n.b
   for i in range(0, number_of_hydrogens):
     name = " H%d " % (i+1)
     if retain_original_hydrogens:
-      if i==0 and ag.get_atom('H'): continue
-    if ag.get_atom(name.strip()): continue
+      if i==0 and 'H' in names: continue
+    if name.strip() in names: continue
     if ag.resname=='PRO':
       if i==0:
         continue
-    atom = iotbx.pdb.hierarchy.atom()
+    atom = _hierarchy_atom()
     atom.name = name
     atom.element = "H"
     atom.xyz = rh3[i]
-    atom.occ = n.occ
-    atom.b = n.b
+    atom.occ = n_occ
+    atom.b = n_b
     atom.segid = ' '*4
     if append_to_end_of_model and i+1==number_of_hydrogens:
       rg = _add_atom_to_chain(atom, ag)
@@ -186,7 +236,6 @@ def add_n_terminal_hydrogens(hierarchy,
                              #residue_selection=None,
                              add_to_chain_breaks=False,
                             ):
-  assert 0
   # add N terminal hydrogens because Reduce only does it to resseq=1
   # needs to be alt.loc. aware for non-quantum-refine
   for chain_i, chain in enumerate(hierarchy.chains()):
@@ -215,12 +264,13 @@ def add_c_terminal_oxygens_to_atom_group(ag,
   atom_name=' OXT'
   atom_element = 'O'
   bond_length=1.231
+  names = set([a.name.strip() for a in ag.atoms()])
   if use_capping_hydrogens:
-    if ag.get_atom(atom_name.strip()): return []
+    if atom_name.strip() in names: return []
     atom_name=" HC "
     atom_element="H"
     bond_length=1.
-  if ag.get_atom(atom_name.strip()): return []
+  if atom_name.strip() in names: return []
   if c_ca_n is not None:
     c, ca, n = c_ca_n
   else:
@@ -243,17 +293,17 @@ def add_c_terminal_oxygens_to_atom_group(ag,
                       period=2,
                      )
   oxys = [' O  ', atom_name]
+  c_occ, c_b = c.occ, c.b
   for i in range(0,2):
     name = oxys[i]
-    atom = ag.get_atom(name.strip())
-    if atom:
+    if name.strip() in names:
       pass #atom.xyz = ro2[i]
     else:
-      atom = iotbx.pdb.hierarchy.atom()
+      atom = _hierarchy_atom()
       atom.name = name
       atom.element = atom_element
-      atom.occ = c.occ
-      atom.b = c.b
+      atom.occ = c_occ
+      atom.b = c_b
       atom.segid = ' '*4
       atom.xyz = ro2[i]
       if append_to_end_of_model:
@@ -283,7 +333,6 @@ def add_c_terminal_oxygens_to_residue_group(residue_group,
 
 def add_c_terminal_oxygens(hierarchy,
                           ):
-  assert 0
   for chain_i, chain in enumerate(hierarchy.chains()):
     for res_i, residue_group in enumerate(chain.residue_groups()):
       if len(residue_group.atom_groups())>1: continue
@@ -292,8 +341,6 @@ def add_c_terminal_oxygens(hierarchy,
                                                "modified_amino_acid",
                                              ]:
         continue
-      if capping_hydrogens:
-        assert 0
       if res_i==len(chain.residue_groups())-1: # need better switch
         add_c_terminal_oxygens_to_atom_group(atom_group)
   hierarchy.atoms_reset_serial()
@@ -333,7 +380,7 @@ def _add_hydrogens_to_atom_group_using_bad(ag,
                       da, dihedral,
                       period=1,
                      )
-  atom = iotbx.pdb.hierarchy.atom()
+  atom = _hierarchy_atom()
   atom.name = atom_name
   atom.element = atom_element
   atom.occ = ba.occ
@@ -400,19 +447,27 @@ def conditional_add_cys_hg_to_atom_group(geometry_restraints_manager,
   if len(sg_bonds)==1:
     add_cys_hg_to_residue_group(rg)
 
+def _get_residue_group_lookup(hierarchy):
+  """
+  Return get_residue_group(residue) for the residues yielded by
+  hierarchy_utils.generate_protein_fragments: the residue group of hierarchy
+  holding the residue's first atom (by i_seq). The atom index -> residue
+  group table is built once instead of walking atom parents per residue.
+  """
+  rgs = []
+  for rg in hierarchy.residue_groups():
+    rgs.extend([rg]*rg.atoms_size())
+  def get_residue_group(residue):
+    return rgs[residue.atoms()[0].i_seq]
+  return get_residue_group
+
 def iterate_over_threes(hierarchy,
                         geometry_restraints_manager,
                         use_capping_hydrogens=False,
                         append_to_end_of_model=False,
                         verbose=False,
                         ):
-  atoms = hierarchy.atoms()
-  ###
-  def get_residue_group(residue):
-    for atom in residue.atoms():
-      atom = atoms[atom.i_seq]
-      break
-    return atom.parent().parent()
+  get_residue_group = _get_residue_group_lookup(hierarchy)
   ###
   additional_hydrogens=hierarchy_utils.smart_add_atoms()
   for three in hierarchy_utils.generate_protein_fragments(
@@ -421,7 +476,7 @@ def iterate_over_threes(hierarchy,
     backbone_only=False,
     use_capping_hydrogens=use_capping_hydrogens,
   ):
-    if verbose: print three
+    if verbose: print(three)
     if not len(three): continue
     ptr=0
     assert three.are_linked()
@@ -585,11 +640,8 @@ def use_electrons_to_add_hdyrogens(hierarchy,
       160.,
       append_to_end_of_model=append_to_end_of_model,
     )
-  def _atom_i_seq(a1, a2):
-    if a1.i_seq<a2.i_seq: return -1
-    return 1
   if remove:
-    remove.sort(_atom_i_seq)
+    remove.sort(key=lambda atom: atom.i_seq)
     remove.reverse()
     for atom in remove:
       # this is a kludge
@@ -658,7 +710,7 @@ def _add_atoms_from_chains_to_end_of_hierarchy(hierarchy, chains):
     lookup[chain.id].append(chain)
   model = hierarchy.models()[0]
   for i, chain_group in sorted(lookup.items()):
-    tc = iotbx.pdb.hierarchy.chain()
+    tc = _hierarchy_chain()
     tc.id = i
     for chain in chain_group:
       for rg in chain.residue_groups():
@@ -669,42 +721,39 @@ def _add_atoms_from_residue_groups_to_end_of_hierarchy(hierarchy, rgs):
   assert 0
   chains = {}
   for rg in rgs:
-    for atom in rg.atoms():
-      # this is a bad idea
-      cid = atom.tmp
-      if cid not in chains:
-        chains[cid] = iotbx.pdb.hierarchy.chain()
-        chains[cid].id = letters[cid]
-      chains[cid].append_residue_group(rg)
+    # this is a bad idea
+    # all atoms of a residue group carry the same chain index, so look at
+    # the first one and append the residue group once
+    cid = rg.atoms()[0].tmp
+    chain = chains.get(cid, None)
+    if chain is None:
+      chain = _hierarchy_chain()
+      chain.id = letters[cid]
+      chains[cid] = chain
+    chain.append_residue_group(rg)
   model = hierarchy.models()[0]
-  for i, chain in sorted(chains.items()):
-    model.append_chain(chain)
+  for cid in sorted(chains):
+    model.append_chain(chains[cid])
 
-def remove_acid_side_chain_hydrogens(hierarchy):
-  removes = {"GLU" : "HE2",
-             "ASP" : "HD2",
-             }
-  for ag in hierarchy.atom_groups():
-    r = removes.get(ag.resname, None)
-    if r is None: continue
-    atom = ag.get_atom(r)
-    if atom:
-      ag.remove_atom(atom)
-  hierarchy.atoms_reset_serial()
-  hierarchy.atoms().reset_i_seq()
+def remove_acid_side_chain_hydrogens(hierarchy, _skip_reset=False):
+  # let the C++ selection find the few acid hydrogens instead of visiting
+  # every atom group; removal stays in place as callers rely on that
+  isel = hierarchy.atom_selection_cache().iselection(
+    "(resname GLU and name HE2) or (resname ASP and name HD2)")
+  atoms = hierarchy.atoms()
+  for i_seq in isel:
+    atom = atoms[i_seq]
+    atom.parent().remove_atom(atom)
+  if not _skip_reset:
+    hierarchy.atoms_reset_serial()
+    hierarchy.atoms().reset_i_seq()
   return hierarchy
 
 def _eta_peptide_h(hierarchy,
                    geometry_restraints_manager,
                    verbose=False,
                    ):
-  atoms = hierarchy.atoms()
-  ###
-  def get_residue_group(residue):
-    for atom in residue.atoms():
-      atom = atoms[atom.i_seq]
-      break
-    return atom.parent().parent()
+  get_residue_group = _get_residue_group_lookup(hierarchy)
   ###
   for three in hierarchy_utils.generate_protein_fragments(
     hierarchy,
@@ -714,12 +763,12 @@ def _eta_peptide_h(hierarchy,
     ):
     if len(three)==1: continue
     if three[-1].resname!='ETA': continue
-    print three
+    print(three)
     eta = get_residue_group(three[-1])
-    print dir(eta)
+    print(dir(eta))
     previous = get_residue_group(three[-2])
-    print previous
-    print dir(previous)
+    print(previous)
+    print(dir(previous))
     for ag in previous.atom_groups(): # smarter?
       previous_c = ag.get_atom('C')
       previous_o = ag.get_atom('O')
@@ -728,7 +777,7 @@ def _eta_peptide_h(hierarchy,
       if ag.get_atom(atom_name):
         assert 0
       else:
-        for atom in ag.atoms(): print atom.format_atom_record()
+        for atom in ag.atoms(): print(atom.format_atom_record())
         rc = _add_hydrogens_to_atom_group_using_bad(
           ag,
           atom_name,
@@ -742,8 +791,8 @@ def _eta_peptide_h(hierarchy,
           #append_to_end_of_model=append_to_end_of_model,
         )
         assert rc is not None
-        print '-'*80
-        for atom in ag.atoms(): print atom.format_atom_record()
+        print('-'*80)
+        for atom in ag.atoms(): print(atom.format_atom_record())
   #      hierarchy.show()
   #assert 0
 
@@ -757,7 +806,7 @@ def generate_atom_group_atom_names(rg, names):
     for atom in ag.atoms():
       atom_altlocs.setdefault(atom.parent().altloc, [])
       atom_altlocs[atom.parent().altloc].append(atom)
-  keys = atom_altlocs.keys()
+  keys = list(atom_altlocs.keys())
   if len(keys)>1 and '' in keys:
     for key in keys:
       if key=='': continue
@@ -779,13 +828,7 @@ def _h_h2_on_N(hierarchy,
                geometry_restraints_manager,
                verbose=False,
                ):
-  atoms = hierarchy.atoms()
-  ###
-  def get_residue_group(residue):
-    for atom in residue.atoms():
-      atom = atoms[atom.i_seq]
-      break
-    return atom.parent().parent()
+  get_residue_group = _get_residue_group_lookup(hierarchy)
   ###
   def get_atom_from_residue_group(residue, label):
     h = None
@@ -818,7 +861,7 @@ def _h_h2_on_N(hierarchy,
                               ca, 109.5,
                               c, dihedral,
                             )
-          atom = iotbx.pdb.hierarchy.atom()
+          atom = _hierarchy_atom()
           atom.name = ' H  '
           atom.element = "H"
           atom.xyz = rh3[0]
@@ -842,6 +885,24 @@ def special_case_hydrogens(hierarchy,
                       )
   hierarchy.sort_atoms_in_place()
 
+def _process_hierarchy(hierarchy, pdb_inp, params, raw_records=None):
+  """
+  Process hierarchy (via its PDB text unless raw_records is given) and give
+  the result the full-precision coordinates that the text rounds off. The
+  coordinates are copied straight from one atom array to the other.
+  """
+  if raw_records is None:
+    raw_records = hierarchy_utils.get_raw_records(pdb_inp, hierarchy)
+  ppf = hierarchy_utils.get_processed_pdb(raw_records=raw_records,
+                                          params=params,
+                                        )
+  ppf.all_chain_proxies.pdb_hierarchy.atoms().set_xyz(
+    hierarchy.atoms().extract_xyz())
+  return ppf
+
+def _atom_names(hierarchy):
+  return list(hierarchy.atoms().extract_name())
+
 def complete_pdb_hierarchy(hierarchy,
                            geometry_restraints_manager,
                            use_capping_hydrogens=False,
@@ -851,7 +912,10 @@ def complete_pdb_hierarchy(hierarchy,
                            original_pdb_filename=None,
                            verbose=False,
                            debug=False,
+                           raw_records=None,
                           ):
+  # raw_records : PDB text of hierarchy as passed in, if the caller already
+  #               has it; only used until the hierarchy is first modified
   for ag in hierarchy.atom_groups():
     if get_class(ag.resname) in ['common_rna_dna']:
       raise Sorry('')
@@ -877,19 +941,14 @@ def complete_pdb_hierarchy(hierarchy,
     if debug:
       ppf = hierarchy_utils.get_processed_pdb(pdb_filename=output)
     else:
-      raw_records = hierarchy_utils.get_raw_records(pdb_inp, hierarchy)
-      ppf = hierarchy_utils.get_processed_pdb(raw_records=raw_records,
-                                              params=params,
-                                            )
-      sites_cart = hierarchy.atoms().extract_xyz()
-      ppf.all_chain_proxies.pdb_hierarchy.atoms().set_xyz(sites_cart)
+      ppf = _process_hierarchy(hierarchy, pdb_inp, params, raw_records)
     n_changed = extend_sidechains.extend_protein_model(
       ppf.all_chain_proxies.pdb_hierarchy,
       mon_lib_server,
       add_hydrogens=False,
     )
     if debug:
-      print 'number of side chains changed',n_changed
+      print('number of side chains changed',n_changed)
       output = hierarchy_utils.write_hierarchy(pdb_filename,
                                                pdb_inp,
                                                ppf.all_chain_proxies.pdb_hierarchy,
@@ -906,21 +965,25 @@ def complete_pdb_hierarchy(hierarchy,
       'readyset_input',
     )
     hierarchy = hierarchy_utils.add_hydrogens_using_ReadySet(output)
+    raw_records = None
   #
   # remove side chain acid hydrogens - maybe not required since recent changes
   #
+  # The hierarchy is only re-processed below when a step actually added,
+  # removed or reordered atoms; otherwise the current ppf and its restraints
+  # still describe it.
+  #
   if debug:
     ppf = hierarchy_utils.get_processed_pdb(pdb_filename=output,
                                             params=params,
                                           )
   else:
-    raw_records = hierarchy_utils.get_raw_records(pdb_inp, hierarchy)
-    ppf = hierarchy_utils.get_processed_pdb(raw_records=raw_records,
-                                            params=params,
-                                          )
-    sites_cart = hierarchy.atoms().extract_xyz()
-    ppf.all_chain_proxies.pdb_hierarchy.atoms().set_xyz(sites_cart)
-  remove_acid_side_chain_hydrogens(ppf.all_chain_proxies.pdb_hierarchy)
+    ppf = _process_hierarchy(hierarchy, pdb_inp, params, raw_records)
+  atom_names = _atom_names(ppf.all_chain_proxies.pdb_hierarchy)
+  # no renumbering needed: if atoms were removed the hierarchy is
+  # re-processed from scratch below
+  remove_acid_side_chain_hydrogens(ppf.all_chain_proxies.pdb_hierarchy,
+                                   _skip_reset=True)
   #
   # add hydrogens in special cases
   #  eg ETA
@@ -930,14 +993,11 @@ def complete_pdb_hierarchy(hierarchy,
     ppf = hierarchy_utils.get_processed_pdb(pdb_filename=output,
                                             params=params,
                                           )
-  else:
-    hierarchy = ppf.all_chain_proxies.pdb_hierarchy
-    raw_records = hierarchy_utils.get_raw_records(pdb_inp, hierarchy)
-    ppf = hierarchy_utils.get_processed_pdb(raw_records=raw_records,
-                                            params=params,
-                                          )
-    sites_cart = hierarchy.atoms().extract_xyz()
-    ppf.all_chain_proxies.pdb_hierarchy.atoms().set_xyz(sites_cart)
+  elif _atom_names(ppf.all_chain_proxies.pdb_hierarchy)!=atom_names:
+    ppf = _process_hierarchy(ppf.all_chain_proxies.pdb_hierarchy,
+                             pdb_inp,
+                             params)
+  atom_names = _atom_names(ppf.all_chain_proxies.pdb_hierarchy)
   special_case_hydrogens(ppf.all_chain_proxies.pdb_hierarchy,
                          ppf.geometry_restraints_manager(),
                          #use_capping_hydrogens=use_capping_hydrogens,
@@ -958,14 +1018,10 @@ def complete_pdb_hierarchy(hierarchy,
     ppf = hierarchy_utils.get_processed_pdb(pdb_filename=output,
                                             params=params,
                                            )
-  else:
-    hierarchy = ppf.all_chain_proxies.pdb_hierarchy
-    raw_records = hierarchy_utils.get_raw_records(pdb_inp, hierarchy)
-    ppf = hierarchy_utils.get_processed_pdb(raw_records=raw_records,
-                                            params=params,
-                                           )
-    sites_cart = hierarchy.atoms().extract_xyz()
-    ppf.all_chain_proxies.pdb_hierarchy.atoms().set_xyz(sites_cart)
+  elif _atom_names(ppf.all_chain_proxies.pdb_hierarchy)!=atom_names:
+    ppf = _process_hierarchy(ppf.all_chain_proxies.pdb_hierarchy,
+                             pdb_inp,
+                             params)
   add_terminal_hydrogens(ppf.all_chain_proxies.pdb_hierarchy,
                          ppf.geometry_restraints_manager(),
                          use_capping_hydrogens=use_capping_hydrogens,
@@ -1007,6 +1063,7 @@ def run(pdb_filename=None,
   if use_capping_hydrogens:
     params = hierarchy_utils.get_pdb_interpretation_params()
     params.link_distance_cutoff=1.8
+  raw_records = None
   if pdb_hierarchy:
     raw_records = hierarchy_utils.get_raw_records(
       pdb_inp=None,
@@ -1031,6 +1088,7 @@ def run(pdb_filename=None,
     original_pdb_filename=original_pdb_filename, # used to define breaks in
                                                  # main chain for capping
     verbose=False,
+    raw_records=raw_records, # same text ppf was built from
   )
   if pdb_filename:
     output = hierarchy_utils.write_hierarchy(
@@ -1042,10 +1100,10 @@ def run(pdb_filename=None,
   return ppf.all_chain_proxies.pdb_hierarchy
 
 def display_hierarchy_atoms(hierarchy, n=5):
-  print '-'*80
-  for i, atom in enumerate(hierarchy.atoms()):
-    print atom.quote()
-    if i>n: break
+  print('-'*80)
+  atoms = hierarchy.atoms()
+  for i in range(min(n+2, atoms.size())):
+    print(atoms[i].quote())
 
 if __name__=="__main__":
   def _fake_phil_parse(arg):
@@ -118,10 +118,11 @@ class minimizer(object):
 
   def callback_after_step(self, minimizer):
     if(self.geometry_rmsd_manager is not None):
-      s = self.calculator.not_hd_selection
-      energies_sites = \
-        self.geometry_rmsd_manager.geometry.select(s).energies_sites(
-          sites_cart        = flex.vec3_double(self.x).select(s),
+      energies_sites = calculator_module.select_restraints(
+        restraints_manager = self.geometry_rmsd_manager.geometry,
+        selection          = self.calculator.not_hd_selection).energies_sites(
+          sites_cart        = flex.vec3_double(self.x).select(
+            self.calculator.not_hd_iselection),
           compute_gradients = False)
       b_mean = energies_sites.bond_deviations()[2]
       if(b_mean>0.03 and self.counter-3>5):
@@ -162,6 +163,7 @@ class clustering_update(object):
     if(rmsd_diff > self.rmsd_tolerance):
       print >> self.log, " rmsd_diff: ", rmsd_diff, "--> need to redo clustering"
       calculator.restraints_manager.fragments.set_up_cluster_qm()
+      calculator.reset_cache()
       print >> self.log, " interacting pairs number:  ", \
         calculator.restraints_manager.fragments.interacting_pairs
       self.pre_sites_cart = sites_cart
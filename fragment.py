@@ -1,6 +1,7 @@
 import os
 import time
 import itertools
+import numpy
 import libtbx.load_env
 from libtbx.utils import Sorry
 from scitbx.array_family import flex
@@ -361,6 +362,16 @@ class fragments(object):
         cluster_pdb_hierarchy = self.pdb_hierarchy.select(cluster_selection)
         cluster_pdb_hierarchy.write_pdb_file(file_name=str(i)+"_cluster.pdb",
           crystal_symmetry=self.expansion.cs_box)
+    # all scales in one array, fragment i is flat[offsets[i]:offsets[i+1]];
+    # the per-fragment lists are only needed while clustering
+    self.fragment_scales_offsets = numpy.cumsum(
+      [0] + [len(s) for s in self.fragment_scales])
+    self.fragment_scales_flat = numpy.fromiter(
+      itertools.chain.from_iterable(self.fragment_scales), dtype=float,
+      count=self.fragment_scales_offsets[-1])
+    del self.fragment_scales
+    self.fragment_selection_counts = [
+      s.count(True) for s in self.fragment_selections]
 
 def get_qm_file_name_and_pdb_hierarchy(fragment_extracts, index):
   fragment_selection = fragment_extracts.fragment_super_selections[index]
@@ -435,11 +446,13 @@ def write_mm_charge_file(fragment_extracts, index):
     sub_working_folder = fragment_extracts.working_folder + "/" + str(index) + "/"
     if (not os.path.isdir(sub_working_folder)):
       os.mkdir(sub_working_folder)
-    if(fragment_extracts.debug): print "write mm pdb file:", index
-    non_fragment_pdb_file = sub_working_folder + str(index) + "_mm.pdb"
-    non_fragment_hierarchy.write_pdb_file(
-      file_name=non_fragment_pdb_file,
-      crystal_symmetry=fragment_extracts.expansion_cs)
+    ## for debugging; the point charges below are written from the hierarchy
+    if(fragment_extracts.debug):
+      print "write mm pdb file:", index
+      non_fragment_pdb_file = sub_working_folder + str(index) + "_mm.pdb"
+      non_fragment_hierarchy.write_pdb_file(
+        file_name=non_fragment_pdb_file,
+        crystal_symmetry=fragment_extracts.expansion_cs)
     non_qm_edge_positions = fragment_utils.get_edge_atom_positions(
       ph, non_fragment_hierarchy, charge_embed=True)
     charge_scaling_positions = non_qm_edge_positions
@@ -481,7 +494,9 @@ def fragment_extracts(fragments):
     pdb_hierarchy_super  = fragments.pdb_hierarchy_super,
     expansion_cs        = fragments.expansion.cs_box,
     buffer_selections    = fragments.buffer_selections,
-    fragment_scales      = fragments.fragment_scales,
+    fragment_scales_flat = fragments.fragment_scales_flat,
+    fragment_scales_offsets = fragments.fragment_scales_offsets,
+    fragment_selection_counts = fragments.fragment_selection_counts,
     debug                = fragments.debug,
     charge_service       = fragments.charge_service,
     charge_cutoff        = fragments.charge_cutoff,
@@ -136,14 +136,11 @@ class Mopac(Calculator):
 
         f = 1
         # write coordinates
-        for iat in range(len(atoms)):
-            atom = atoms[iat]
-            xyz = atom.position
-            mopac_input += ' %2s' % atom.symbol
-            # write x, y, z
-            for idir in range(3):
-                mopac_input += '    %16.5f %i' % (xyz[idir], f)
-            mopac_input += '\n'
+        line_format = ' %2s' + ('    %16.5f ' + str(f)) * 3 + '\n'
+        mopac_input += ''.join([
+            line_format % (symbol, xyz[0], xyz[1], xyz[2])
+            for symbol, xyz in zip(atoms.get_chemical_symbols(),
+                                   atoms.get_positions())])
 
         if atoms.pbc.any():
             for v in atoms.get_cell():
@@ -206,32 +203,35 @@ class Mopac(Calculator):
 #        if exitcode != 0:
 #            raise RuntimeError('MOPAC exited with error code')
 
-        self.version = self.read_version(foutput)
-        energy = self.read_energy(foutput)
+        lines = open(foutput).readlines()
+        self.version = self.read_version(foutput, lines=lines)
+        energy = self.read_energy(foutput, lines=lines)
         self.energy_zero = energy
         self.energy_free = energy
-        self.forces = self.read_forces(foutput)
+        self.forces = self.read_forces(foutput, lines=lines)
 
-    def read_version(self, fname):
+    def read_version(self, fname, lines=None):
         """
         Reads the MOPAC version string from the second line
         """
         version = 'unknown'
-        lines = open(fname).readlines()
+        if lines is None:
+            lines = open(fname).readlines()
         for line in lines:
             if "  Version" in line:
                 version = line.split()[-2]
                 break
         return version
 
-    def read_energy(self, fname):
+    def read_energy(self, fname, lines=None):
         """
         Reads the ENERGY from the output file (HEAT of FORMATION in kcal / mol)
         Raises RuntimeError if no energy was found
         """
-        outfile = open(fname)
-        lines = outfile.readlines()
-        outfile.close()
+        if lines is None:
+            outfile = open(fname)
+            lines = outfile.readlines()
+            outfile.close()
 
         energy = None
         for line in lines:
@@ -249,14 +249,15 @@ class Mopac(Calculator):
         energy *= (kcal / mol)
         return energy
 
-    def read_forces(self, fname):
+    def read_forces(self, fname, lines=None):
         """
         Reads the FORCES from the output file
         search string: (HEAT of FORMATION in kcal / mol / AA)
         """
-        outfile = open(fname)
-        lines = outfile.readlines()
-        outfile.close()
+        if lines is None:
+            outfile = open(fname)
+            lines = outfile.readlines()
+            outfile.close()
         nats = len(self.atoms)
         forces = np.zeros((nats, 3), float)
         infinite_force="*****"
@@ -24,9 +24,11 @@ import os
 import sys
 import time
 import pickle
+import cPickle
 import mmtbx.command_line
 import mmtbx.f_model
 import mmtbx.utils
+import libtbx.load_env
 from libtbx.utils import Sorry
 from libtbx import easy_pickle
 from libtbx import group_args
@@ -83,12 +85,15 @@ quantum {
     .type = str
   nproc = None
     .type = int
+  charge_cache_folder = None
+    .type = str
+    .help = Keep total charges here and reuse them for identical input
 }
 
 refine {
   dry_run=False
     .type = bool
-  sf_algorithm = *direct fft
+  sf_algorithm = direct *fft
     .type = choice(multi=False)
   refinement_target_name = *ml ls_wunit_k1
     .type = choice
@@ -151,6 +156,9 @@ shared_disk = True
   .type = bool
 rst_file = None
   .type = str
+model_cache_folder = None
+  .type = str
+  .help = Keep processed input models here and reuse them for identical input
 
 dump_gradients=None
   .type = str
@@ -160,12 +168,24 @@ def get_master_phil():
   return mmtbx.command_line.generate_master_phil_with_inputs(
     phil_string=master_params_str)
 
+def get_sf_and_grads_accuracy_params(params):
+  """
+  Structure factor algorithm for fmodel as chosen by refine.sf_algorithm.
+  Defaults to the mmtbx choice (fft); direct summation scales with
+  N_atoms*N_hkl and only pays off for very small models.
+  """
+  result = mmtbx.f_model.sf_and_grads_accuracy_master_params.extract()
+  result.algorithm = params.refine.sf_algorithm
+  return result
+
 def create_fmodel(cmdline, log):
   fmodel = mmtbx.f_model.manager(
     f_obs          = cmdline.f_obs,
     r_free_flags   = cmdline.r_free_flags,
     xray_structure = cmdline.xray_structure,
-    target_name    = cmdline.params.refine.refinement_target_name)
+    target_name    = cmdline.params.refine.refinement_target_name,
+    sf_and_grads_accuracy_params = get_sf_and_grads_accuracy_params(
+      params = cmdline.params))
   if(cmdline.params.refine.update_all_scales):
     fmodel.update_all_scales(remove_outliers=False)
     fmodel.show(show_header=False, show_approx=False)
@@ -173,7 +193,60 @@ def create_fmodel(cmdline, log):
   log.flush()
   return fmodel
 
-def process_model_file(pdb_file_name, cif_objects, crystal_symmetry):
+def _restraints_library_version():
+  """
+  Identifies the cctbx build and monomer library that processed a model, so
+  that cached models are not reused across upgrades.
+  """
+  import mmtbx.monomer_library.server
+  result = []
+  try:
+    from libtbx.version import get_version
+    result.append(str(get_version()))
+  except ImportError:
+    pass
+  paths = [mmtbx.model.__file__, mmtbx.monomer_library.server.__file__]
+  for name in ["chem_data", "mon_lib"]:
+    paths.append(libtbx.env.find_in_repositories(relative_path=name))
+  for name in ["MMTBX_CCP4_MONOMER_LIB", "CLIBD_MON"]:
+    paths.append(os.environ.get(name))
+  for path in paths:
+    if(path is not None and os.path.exists(path)):
+      result.append("%s %s" % (path, os.path.getmtime(path)))
+  return "\n".join(result)
+
+def process_model_file(pdb_file_name, cif_objects, crystal_symmetry,
+                       cache_folder=None, log=sys.stdout):
+  if(cache_folder is None):
+    return _process_model_file(pdb_file_name, cif_objects, crystal_symmetry)
+  import hashlib
+  h = hashlib.sha1(open(pdb_file_name, "rb").read())
+  for cif_object in (cif_objects or []):
+    h.update(str(cif_object[1]))
+  h.update(str(crystal_symmetry))
+  h.update(_restraints_library_version())
+  key = h.hexdigest()
+  cache_file = os.path.join(cache_folder, "model_%s.pkl" % key)
+  if(os.path.isfile(cache_file)):
+    try:
+      cached_key, result = easy_pickle.load(cache_file)
+      if(cached_key == key): return result
+    except Exception:
+      pass
+  result = _process_model_file(pdb_file_name, cif_objects, crystal_symmetry)
+  if(not os.path.isdir(cache_folder)):
+    os.makedirs(cache_folder)
+  # easy_pickle uses cPickle, which has its own PicklingError and reports
+  # unpicklable objects as TypeError
+  try:
+    easy_pickle.dump(cache_file, (key, result))
+  except (IOError, OSError, TypeError, pickle.PicklingError,
+          cPickle.PicklingError) as e:
+    print >> log, "Model not cached (%s)" % str(e)
+    if(os.path.isfile(cache_file)): os.remove(cache_file)
+  return result
+
+def _process_model_file(pdb_file_name, cif_objects, crystal_symmetry):
   import iotbx.pdb
   params = mmtbx.model.manager.get_default_pdb_interpretation_params()
   params.pdb_interpretation.use_neutron_distances = True
@@ -233,6 +306,7 @@ def create_restraints_manager(
       qm_engine_name             = params.quantum.engine_name,
       memory                     = params.quantum.memory,
       nproc                      = params.quantum.nproc,
+      charge_cache_folder        = params.quantum.charge_cache_folder,
       crystal_symmetry           = model.xray_structure.crystal_symmetry(),
       clustering                 = params.cluster.clustering)
   return restraints_manager
@@ -263,22 +337,22 @@ def create_calculator(weights, params, restraints_manager, fmodel=None,
       restraints_manager = restraints_manager,
       weights            = weights)
 
+# quantum.method and quantum.basis used when left as Auto, per engine
+_quantum_defaults = {
+  "mopac"  : (("method", "PM7"), ("basis", "")),
+  None     : (("method", "HF"),  ("basis", "STO-3G")),
+}
+
 def validate(model, fmodel, params, rst_file, prefix, log):
   # set defaults
   outl = ''
-  if params.quantum.engine_name=='mopac':
-    if params.quantum.method==Auto:
-      params.quantum.method='PM7'
-      outl += '  Setting QM method to PM7\n'
-    if params.quantum.basis==Auto:
-      params.quantum.basis=''
-  else:
-    if params.quantum.method==Auto:
-      params.quantum.method='HF'
-      outl += '  Setting QM method to HF\n'
-    if params.quantum.basis==Auto:
-      params.quantum.basis='STO-3G'
-      outl += '  Setting QM basis to STO-3G\n'
+  defaults = _quantum_defaults.get(params.quantum.engine_name,
+                                   _quantum_defaults[None])
+  for attr, value in defaults:
+    if getattr(params.quantum, attr)==Auto:
+      setattr(params.quantum, attr, value)
+      if value:
+        outl += '  Setting QM %s to %s\n' % (attr, value)
   if outl:
     print >> log, '\nSetting QM defaults'
     print >> log, outl
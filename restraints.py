@@ -1,19 +1,50 @@
 from __future__ import division
 
 import os
+import numpy
+import hashlib
 import ase.units as ase_units
 import mmtbx.restraints
 from libtbx.utils import Sorry
 from charges import charges_class
 from scitbx.array_family import flex
 from clustering import betweenness_centrality_clustering
-from plugin.ase.mopac_qr import Mopac
-from plugin.ase.pyscf_qr import Pyscf
-from plugin.ase.terachem_qr import TeraChem
-from plugin.ase.turbomole_qr import Turbomole
-from plugin.ase.orca_qr import Orca
-from plugin.ase.gaussian_qr import Gaussian
 from libtbx import group_args
+from libtbx import easy_pickle
+
+_total_charge_cache = {}
+
+def get_total_charge(raw_records, cif_objects=None, cache_folder=None):
+  """
+  Total charge of the model in raw_records. Charge perception is slow and
+  deterministic, so results are kept in memory and, if cache_folder is
+  given, in a pickle there that records the input hash it was built from.
+  """
+  h = hashlib.sha1(raw_records)
+  for cif_object in (cif_objects or []):
+    h.update(str(cif_object[1]))
+  key = h.hexdigest()
+  if(key in _total_charge_cache): return _total_charge_cache[key]
+  cache_file = None
+  if(cache_folder is not None):
+    cache_file = os.path.join(cache_folder, "charge_%s.pkl" % key)
+    if(os.path.isfile(cache_file)):
+      try:
+        cached_key, total_charge = easy_pickle.load(cache_file)
+      except Exception:
+        cached_key = None
+      if(cached_key == key):
+        _total_charge_cache[key] = total_charge
+        return total_charge
+  charge_service = charges_class(raw_records = raw_records,
+                                 cif_objects = cif_objects)
+  total_charge = charge_service.get_total_charge()
+  _total_charge_cache[key] = total_charge
+  if(cache_file is not None):
+    if(not os.path.isdir(cache_folder)):
+      os.makedirs(cache_folder)
+    easy_pickle.dump(cache_file, (key, total_charge))
+  return total_charge
 
 class from_cctbx(object):
   def __init__(self, restraints_manager, fragment_extracts=None,
@@ -21,6 +52,35 @@ class from_cctbx(object):
     self.geometry_restraints_manager = restraints_manager
     self.file_name = file_name
     self.fragment_extracts = fragment_extracts
+    self._fragment_cache = {}
+    self._fragment_cache_key = None
+
+  def get_fragment_restraints(self, index):
+    """
+    Restraints manager, atom count and gradient scales of fragment index.
+    These only change on re-clustering, which replaces the super-sphere
+    restraints manager and the fragment lists, so they are cached per index
+    until one of those objects changes.
+    """
+    fe = self.fragment_extracts
+    key = (fe.super_sphere_geometry_restraints_manager,
+           fe.fragment_super_selections, fe.fragment_selection_counts,
+           fe.fragment_scales_flat)
+    if(self._fragment_cache_key is None or
+       not all(a is b for a, b in zip(key, self._fragment_cache_key))):
+      self._fragment_cache = {}
+      self._fragment_cache_key = key
+    result = self._fragment_cache.get(index)
+    if(result is None):
+      offsets = fe.fragment_scales_offsets
+      result = (
+        fe.super_sphere_geometry_restraints_manager.select(
+          fe.fragment_super_selections[index]),
+        fe.fragment_selection_counts[index],
+        flex.double(
+          fe.fragment_scales_flat[offsets[index]:offsets[index+1]].tolist()))
+      self._fragment_cache[index] = result
+    return result
 
   def __call__(self, selection_and_sites_cart):
     return self.target_and_gradients(
@@ -36,13 +96,16 @@ class from_cctbx(object):
 
   def target_and_gradients(self, sites_cart, selection=None, index=None):
     if(selection is not None): ### clustering
+      # from_cluster passes the fragment's sites only; full super-sphere
+      # sites are still accepted
       super_selection = self.fragment_extracts.fragment_super_selections[index]
-      grm = self.fragment_extracts.super_sphere_geometry_restraints_manager
-      es = grm.select(super_selection).energies_sites(
-        sites_cart=sites_cart.select(super_selection), compute_gradients=True)
-      es.gradients = es.gradients[:selection.count(True)]
-      es.gradients = es.gradients * flex.double(
-            self.fragment_extracts.fragment_scales[index])
+      if(sites_cart.size() == super_selection.size()):
+        sites_cart = sites_cart.select(super_selection)
+      grm, n_selected, scales = self.get_fragment_restraints(index)
+      es = grm.energies_sites(
+        sites_cart=sites_cart, compute_gradients=True)
+      es.gradients = es.gradients[:n_selected]
+      es.gradients = es.gradients * scales
     else:
       es = self.geometry_restraints_manager.energies_sites(
         sites_cart=sites_cart, compute_gradients=True)
@@ -64,12 +127,14 @@ class from_qm(object):
       basis                      = "sto-3g",
       memory                     = None,
       nproc                      = None,
+      charge_cache_folder        = None,
   ):
     self.fragment_extracts  = fragment_extracts
     self.method = method
     self.basis = basis
     self.memory = memory
     self.nproc = nproc
+    self.nproc_per_job = None
 
     self.pdb_hierarchy = pdb_hierarchy
     self.qm_engine_name = qm_engine_name
@@ -83,35 +148,53 @@ class from_qm(object):
       #self.charge = cc.get_total_charge()
       #@Nigel
       raw_records = pdb_hierarchy.as_pdb_string(crystal_symmetry=crystal_symmetry)
-      charge_service = charges_class(raw_records = raw_records,
-                                     cif_objects = cif_objects)
-      self.charge = charge_service.get_total_charge()
+      self.charge = get_total_charge(raw_records  = raw_records,
+                                     cif_objects  = cif_objects,
+                                     cache_folder = charge_cache_folder)
     else: self.charge = charge
     self.clustering = clustering
     self.qm_engine = self.create_qm_engine()
     self.qm_engine.command = self.qm_engine.get_command()
     self.system_size = self.pdb_hierarchy.atoms_size()
+    self._atoms = None
+    self._full_scale = numpy.ones(self.system_size)
+    # the engines write their own inputs from the ASE atoms; the model file
+    # is only kept for reference, so write it once instead of every call
+    if(not self.clustering):
+      self.pdb_hierarchy.write_pdb_file(file_name=self.file_name,
+        crystal_symmetry=crystal_symmetry)
 
-  def create_qm_engine(self):
+  def _new_qm_engine(self):
+    # plugins are imported on demand; some pull in heavy backends
     if(self.qm_engine_name == "turbomole"):
+      from plugin.ase.turbomole_qr import Turbomole
       calculator = Turbomole()
     elif(self.qm_engine_name == "terachem"):
       ### if TeraChem has problem reading pdb file, update TeraChem version.
+      from plugin.ase.terachem_qr import TeraChem
       calculator = TeraChem(gpus="4",
                             basis=self.basis,
                             dftd="yes",
                             watcheindiis="yes",
                             scf="diis+a")
     elif(self.qm_engine_name == "mopac"):
+      from plugin.ase.mopac_qr import Mopac
       calculator = Mopac()
     elif(self.qm_engine_name == "pyscf"):
+      from plugin.ase.pyscf_qr import Pyscf
       calculator = Pyscf()
     elif(self.qm_engine_name == "orca"):
+      from plugin.ase.orca_qr import Orca
       calculator = Orca()
     elif(self.qm_engine_name == "gaussian"):
+      from plugin.ase.gaussian_qr import Gaussian
       calculator = Gaussian()
     else:
       raise Sorry("qm_calculator needs to be specified.")
+    return calculator
+
+  def create_qm_engine(self):
+    calculator = self._new_qm_engine()
     #
     # set to appropriate values
     #
@@ -134,6 +217,16 @@ class from_qm(object):
           print '  No function available to set %s to %s' % (attr, value)
     return calculator
 
+  def share_nproc(self, n_jobs):
+    """
+    Split quantum.nproc between n_jobs fragment calculations running at the
+    same time so that the node is not oversubscribed. The share is handed to
+    the engine on each run; only engines with set_nproc (Gaussian) use it.
+    """
+    self.nproc_per_job = None
+    if(self.nproc is None): return
+    self.nproc_per_job = max(1, self.nproc//max(1, n_jobs))
+
   def __call__(self,fragment_selection_and_sites_cart):
     return self.target_and_gradients(
       sites_cart = fragment_selection_and_sites_cart[1],
@@ -160,16 +253,18 @@ class from_qm(object):
                                       index=index)
       charge_file =  write_mm_charge_file(fragment_extracts=self.fragment_extracts,
                                       index=index)
-      gradients_scale = self.fragment_extracts.fragment_scales[index]
+      offsets = self.fragment_extracts.fragment_scales_offsets
+      gradients_scale = self.fragment_extracts.fragment_scales_flat[
+        offsets[index]:offsets[index+1]]
+      n_selected = self.fragment_extracts.fragment_selection_counts[index]
     else:
       self.pdb_hierarchy.atoms().set_xyz(sites_cart)
-      self.pdb_hierarchy.write_pdb_file(file_name=self.file_name)
       ph = self.pdb_hierarchy## return pdb_hierarchy
       qm_pdb_file = self.file_name
       qm_charge = self.charge
       charge_file = None
-      selection =flex.bool(self.system_size, True)
-      gradients_scale = [1.0]*self.system_size
+      gradients_scale = self._full_scale
+      n_selected = self.system_size
     #
     # need to get commands for QM programs from local machine so queue machines
     # know where to look.
@@ -188,8 +283,21 @@ class from_qm(object):
       command = self.qm_engine.get_command()
     else:
       assert 0
-    atoms = ase_atoms_from_pdb_hierarchy(ph)
+    if(self.clustering):
+      atoms = ase_atoms_from_pdb_hierarchy(ph)
+    else:
+      # the engines copy or only read the atoms they are given, so one
+      # Atoms object can be kept and moved to the new coordinates
+      if(self._atoms is None):
+        self._atoms = ase_atoms_from_pdb_hierarchy(ph)
+      else:
+        self._atoms.set_positions(
+          sites_cart.as_double().as_numpy_array().reshape(-1, 3))
+      atoms = self._atoms
     self.qm_engine.set_label(qm_pdb_file[:-4])
+    nproc = self.nproc_per_job or self.nproc
+    set_nproc = getattr(self.qm_engine, 'set_nproc', None)
+    if(nproc is not None and set_nproc is not None): set_nproc(nproc)
     self.qm_engine.run_qr(atoms,
                           charge=qm_charge,
                           pointcharges=charge_file,
@@ -199,30 +307,21 @@ class from_qm(object):
       )
     unit_convert = ase_units.mol/ase_units.kcal
     energy = self.qm_engine.energy_free*unit_convert
-    ase_gradients = (-1.0) * self.qm_engine.forces*unit_convert
     # remove capping and neibouring buffer
-    gradients = ase_gradients[:selection.count(True)]
-    gradients =  flex.vec3_double(gradients)
+    gradients = numpy.array(self.qm_engine.forces[:n_selected], dtype=float)
     ## TODO
     ## unchange the altloc gradient, averagely scale the non-altloc gradient
-    gradients = gradients*flex.double(gradients_scale)
-    return energy, gradients
+    gradients *= (-unit_convert) * numpy.asarray(
+      gradients_scale, dtype=float)[:, numpy.newaxis]
+    return energy, flex.vec3_double(gradients)
 
 from ase import Atoms
 def ase_atoms_from_pdb_hierarchy(ph):
-
-  def read_pdb_hierarchy(pdb_hierarchy):
-    positions = []
-    symbols = []
-    for chain in pdb_hierarchy.chains():
-      for residue_group in chain.residue_groups():
-        for atom in residue_group.atoms():
-          element = atom.element.strip()
-          if (len(element) == 2):
-            element = element[0] + element[1].lower()
-          symbols.append(element)
-          positions.append(list(atom.xyz))
-    return symbols, positions
-
-  symbols, positions = read_pdb_hierarchy(ph)
-  return Atoms(symbols=symbols, positions=positions)
+  symbols = []
+  for element in ph.atoms().extract_element():
+    element = element.strip()
+    if (len(element) == 2):
+      element = element[0] + element[1].lower()
+    symbols.append(element)
+  positions = ph.atoms().extract_xyz().as_double().as_numpy_array()
+  return Atoms(symbols=symbols, positions=positions.reshape(-1, 3))
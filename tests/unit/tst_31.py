@@ -0,0 +1,28 @@
+from __future__ import division
+
+import math
+import run_tests
+from scitbx.array_family import flex
+from libtbx.test_utils import approx_equal
+from qrefine.calculator import _filtered_norm
+
+def run(prefix):
+  """
+  Exercise _filtered_norm: outliers are dropped and do not swamp the norm.
+  """
+  # no outliers: plain norm
+  g = flex.vec3_double([(1,2,3), (-1,0,2), (0.5,0.5,0.5)])
+  assert approx_equal(_filtered_norm(g), math.sqrt(flex.sum(g.dot())))
+  # one dominating outlier is removed, the rest is summed exactly
+  g = flex.vec3_double([(1.e9,0,0)] + [(1,0,0)]*999)
+  assert approx_equal(_filtered_norm(g), math.sqrt(999))
+  # outlier below the cutoff (36 x mean squared length) is kept
+  g = flex.vec3_double([(5,0,0)] + [(1,0,0)]*99)
+  assert approx_equal(_filtered_norm(g), math.sqrt(25+99))
+  # all zero
+  assert _filtered_norm(flex.vec3_double(10, (0,0,0))) == 0
+
+if(__name__ == "__main__"):
+  prefix="tst_31"
+  rc = run_tests.runner(function=run, prefix=prefix, disable=False)
+  assert not rc, '%s rc: %s' % (prefix, rc)
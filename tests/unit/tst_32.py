@@ -0,0 +1,45 @@
+from __future__ import division
+
+import run_tests
+from qrefine.calculator import weight_scale_action
+
+def cascade(bonds_rmsd, max_bond_rmsd, rf, rw):
+  """
+  The original if-cascade of weights.adjust_restraints_weight_scale.
+  """
+  if(bonds_rmsd>max_bond_rmsd):
+    return 1
+  if(rf<rw):
+    return -1
+  if(bonds_rmsd<max_bond_rmsd and rf>rw and abs(rf-rw)*100.<5.):
+    return -1
+  if(bonds_rmsd<max_bond_rmsd and rf>rw and abs(rf-rw)*100.>5.):
+    return 1
+  return 0
+
+def run(prefix):
+  """
+  Exercise weight_scale_action against the original cascade, including the
+  exact boundaries (bond rmsd at max, r_free == r_work, 5% gap).
+  """
+  max_bond_rmsd = 0.03
+  rmsds = [0., 0.01, 0.0299, 0.03, 0.0301, 0.05]
+  r_values = [i/1000. for i in xrange(100, 401, 5)]
+  n_zero = 0
+  for bonds_rmsd in rmsds:
+    for rf in r_values:
+      for rw in r_values:
+        expected = cascade(bonds_rmsd, max_bond_rmsd, rf, rw)
+        result = weight_scale_action(bonds_rmsd, max_bond_rmsd, rf, rw)
+        assert result == expected, (bonds_rmsd, rf, rw, result, expected)
+        if(expected == 0): n_zero += 1
+  # the boundary cases are actually reached by the grid
+  assert n_zero > 0
+  assert weight_scale_action(0.01, max_bond_rmsd, 0.25, 0.25) == 0
+  assert weight_scale_action(0.03, max_bond_rmsd, 0.30, 0.20) == 0
+  assert weight_scale_action(0.03, max_bond_rmsd, 0.20, 0.30) == -1
+
+if(__name__ == "__main__"):
+  prefix="tst_32"
+  rc = run_tests.runner(function=run, prefix=prefix, disable=False)
+  assert not rc, '%s rc: %s' % (prefix, rc)
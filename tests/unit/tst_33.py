@@ -0,0 +1,73 @@
+from __future__ import division
+
+import numpy
+import run_tests
+from libtbx import easy_mp
+from libtbx import group_args
+from scitbx.array_family import flex
+from qrefine.restraints import from_cctbx
+
+class counting_manager(object):
+  """
+  Stands in for the super-sphere restraints manager; counts select() calls.
+  """
+  def __init__(self):
+    self.n_select = 0
+
+  def select(self, selection):
+    self.n_select += 1
+    return group_args(parent=self, n_atoms=selection.count(True))
+
+def clustering_result(grm):
+  selections = [flex.bool([True, True, False, False]),
+                flex.bool([False, True, True, True])]
+  return group_args(
+    super_sphere_geometry_restraints_manager = grm,
+    fragment_super_selections = selections,
+    fragment_selection_counts = [s.count(True) for s in selections],
+    fragment_scales_offsets   = numpy.array([0, 2, 5]),
+    fragment_scales_flat      = numpy.ones(5))
+
+def run(prefix):
+  """
+  Exercise the per-fragment restraints cache of from_cctbx: entries are
+  reused between steps, dropped on re-clustering, and a cache filled before
+  forking is inherited by the workers.
+  """
+  grm_1 = counting_manager()
+  clusters_1 = clustering_result(grm_1)
+  rm = from_cctbx(restraints_manager=None, fragment_extracts=clusters_1)
+  r0 = rm.get_fragment_restraints(0)
+  assert r0[0].parent is grm_1 and r0[1] == 2
+  assert rm.get_fragment_restraints(0) is r0
+  # from_cluster makes a new fragment_extracts object on every step from the
+  # same clustering: still cached
+  rm.fragment_extracts = group_args(**clusters_1.__dict__)
+  assert rm.get_fragment_restraints(0) is r0
+  assert grm_1.n_select == 1
+  # re-clustering replaces the restraints manager and the fragment lists
+  grm_2 = counting_manager()
+  rm.fragment_extracts = clustering_result(grm_2)
+  r0_new = rm.get_fragment_restraints(0)
+  assert r0_new is not r0
+  assert r0_new[0].parent is grm_2
+  assert grm_1.n_select == 1 and grm_2.n_select == 1
+  # new fragment lists with the same restraints manager invalidate as well
+  rm.fragment_extracts = clustering_result(grm_2)
+  assert rm.get_fragment_restraints(0) is not r0_new
+  assert grm_2.n_select == 2
+  # filled before the fork, as from_cluster does: workers do not select again
+  grm_3 = counting_manager()
+  rm.fragment_extracts = clustering_result(grm_3)
+  for index in range(2):
+    rm.get_fragment_restraints(index)
+  def worker(index):
+    result = rm.get_fragment_restraints(index)
+    return result[0].parent.n_select, result[1]
+  results = easy_mp.pool_map(fixed_func=worker, args=range(2), processes=2)
+  assert results == [(2, 2), (2, 3)], results
+
+if(__name__ == "__main__"):
+  prefix="tst_33"
+  rc = run_tests.runner(function=run, prefix=prefix, disable=False)
+  assert not rc, '%s rc: %s' % (prefix, rc)
@@ -0,0 +1,71 @@
+from __future__ import division
+
+import os
+import shutil
+import iotbx.pdb
+import run_tests
+from libtbx.test_utils import approx_equal
+from qrefine import qr
+
+qr_unit_tests_data = run_tests.qr_unit_tests_data
+
+def restraints_summary(result):
+  grm = result.model.get_restraints_manager().geometry
+  es = grm.energies_sites(
+    sites_cart        = result.xray_structure.sites_cart(),
+    compute_gradients = True)
+  return (
+    es.target,
+    list(es.gradients.as_double()),
+    grm.pair_proxies().bond_proxies.simple.size(),
+    grm.angle_proxies.size(),
+    grm.dihedral_proxies.size(),
+    grm.planarity_proxies.size(),
+    grm.chirality_proxies.size())
+
+def run(prefix):
+  """
+  Exercise the model cache of process_model_file: a model loaded from the
+  cache has the same restraints as a freshly processed one.
+  """
+  pdb_file_name = os.path.join(qr_unit_tests_data, "helix.pdb")
+  cs = iotbx.pdb.input(file_name=pdb_file_name).crystal_symmetry()
+  cache_folder = "%s_model_cache" % prefix
+  try:
+    fresh = qr.process_model_file(
+      pdb_file_name    = pdb_file_name,
+      cif_objects      = [],
+      crystal_symmetry = cs)
+    first = qr.process_model_file(
+      pdb_file_name    = pdb_file_name,
+      cif_objects      = [],
+      crystal_symmetry = cs,
+      cache_folder     = cache_folder)
+    assert len(os.listdir(cache_folder)) == 1
+    # the second call must come from the cache, not from processing
+    process = qr._process_model_file
+    qr._process_model_file = None
+    try:
+      cached = qr.process_model_file(
+        pdb_file_name    = pdb_file_name,
+        cif_objects      = [],
+        crystal_symmetry = cs,
+        cache_folder     = cache_folder)
+    finally:
+      qr._process_model_file = process
+    assert cached is not first
+    s_fresh = restraints_summary(fresh)
+    s_cached = restraints_summary(cached)
+    assert approx_equal(s_fresh[0], s_cached[0])
+    assert approx_equal(s_fresh[1], s_cached[1])
+    assert s_fresh[2:] == s_cached[2:]
+    assert approx_equal(
+      cached.pdb_hierarchy.atoms().extract_xyz(),
+      fresh.pdb_hierarchy.atoms().extract_xyz())
+  finally:
+    if(os.path.isdir(cache_folder)): shutil.rmtree(cache_folder)
+
+if(__name__ == "__main__"):
+  prefix="tst_34"
+  rc = run_tests.runner(function=run, prefix=prefix, disable=False)
+  assert not rc, '%s rc: %s' % (prefix, rc)
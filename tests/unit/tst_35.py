@@ -0,0 +1,47 @@
+from __future__ import division
+
+import os
+import iotbx.pdb
+import run_tests
+from libtbx.test_utils import approx_equal
+from qrefine import qr
+from qrefine import calculator
+
+qr_unit_tests_data = run_tests.qr_unit_tests_data
+
+def run(prefix):
+  """
+  Exercise get_bonds_rmsd on a real geometry restraints manager: the cached
+  not-H selections give the same bond rmsd as selecting by hand.
+  """
+  pdb_file_name = os.path.join(qr_unit_tests_data, "helix.pdb")
+  cs = iotbx.pdb.input(file_name=pdb_file_name).crystal_symmetry()
+  model = qr.process_model_file(
+    pdb_file_name    = pdb_file_name,
+    cif_objects      = [],
+    crystal_symmetry = cs)
+  grm = model.model.get_restraints_manager().geometry
+  xrs = model.xray_structure
+  not_hd_sel = ~xrs.hd_selection()
+  assert not_hd_sel.count(False) > 0
+  expected = grm.select(not_hd_sel).energies_sites(
+    sites_cart        = xrs.sites_cart().select(not_hd_sel),
+    compute_gradients = False).bond_deviations()[2]
+  result = calculator.get_bonds_rmsd(restraints_manager=grm, xrs=xrs)
+  assert approx_equal(result, expected)
+  # shifted sites must not come from the memo
+  xrs_shaken = xrs.deep_copy_scatterers()
+  xrs_shaken.shake_sites_in_place(mean_distance=0.1)
+  expected = grm.select(not_hd_sel).energies_sites(
+    sites_cart        = xrs_shaken.sites_cart().select(not_hd_sel),
+    compute_gradients = False).bond_deviations()[2]
+  result_shaken = calculator.get_bonds_rmsd(
+    restraints_manager = grm,
+    xrs                = xrs_shaken)
+  assert approx_equal(result_shaken, expected)
+  assert result_shaken > result
+
+if(__name__ == "__main__"):
+  prefix="tst_35"
+  rc = run_tests.runner(function=run, prefix=prefix, disable=False)
+  assert not rc, '%s rc: %s' % (prefix, rc)